@@ -1,8 +1,9 @@
 import streamlit as st
-from PIL import Image
 import utils
 import io
 import os
+import queue
+import hashlib
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -94,7 +95,7 @@ with col1:
     uploaded_file = st.file_uploader("Upload an image", type=["png", "jpg", "jpeg"])
     base_image = None
     if uploaded_file:
-        base_image = Image.open(uploaded_file)
+        base_image = utils.open_base_image(uploaded_file)
         st.image(base_image, caption="Base Character", use_container_width=True)
 
 with col2:
@@ -116,9 +117,15 @@ with col2:
         height=200
     )
     
-    lines = [line.strip() for line in text_input.split('\n') if line.strip()]
+    lines = [s for line in text_input.splitlines() if (s := line.strip())]
     
     st.caption(f"Count Check: You have {len(lines)} lines of text. (Target: {stamp_count})")
+    
+    reuse_stamps = st.checkbox(
+        "Reuse previously generated stamps",
+        value=True,
+        help="Stamps whose text and character haven't changed are shown again instead of regenerated. Uncheck to get new variations."
+    )
 
 # --- Generation Logic ---
 if st.button("🚀 Generate Stamps"):
@@ -143,33 +150,68 @@ if st.button("🚀 Generate Stamps"):
         
         MAX_ITEMS = min(stamp_count, len(lines))
         
-        for i in range(MAX_ITEMS):
-            text = lines[i]
-            status_text.text(f"Generating stamp {i+1}/{MAX_ITEMS}: '{text}'...")
-            
-            # Generate
-            img, error_msg = utils.generate_stamp(base_image, text, style_prompt="Anime style, cute, expressive")
+        # One placeholder per stamp, so each fills its own grid cell whenever it finishes
+        slots = [cols[i % 4].empty() for i in range(MAX_ITEMS)]
+        
+        def show_result(i, text, img, png_bytes, error_msg, done):
+            status_text.text(f"Generated {done}/{MAX_ITEMS}: '{text}'")
             
             if img:
-                generated_images[f"sticker_{i+1:02d}.png"] = img
+                generated_images[f"sticker_{i+1:02d}.png"] = png_bytes
                 
                 # Display in grid
-                with cols[i % 4]:
-                    st.image(img, caption=text, use_container_width=True)
+                slots[i].image(img, caption=text, use_container_width=True)
             else:
                 st.warning(f"Failed to generate: {text}\nError: {error_msg}")
             
             # Update Progress
-            progress_bar.progress((i + 1) / MAX_ITEMS)
-            
+            progress_bar.progress(done / MAX_ITEMS)
+        
+        # Reuse the description across reruns while the same image is uploaded
+        img_hash = hashlib.blake2b(uploaded_file.getvalue(), digest_size=8).hexdigest()
+        desc_cache = st.session_state.setdefault('desc_cache', {})
+        if img_hash in desc_cache:
+            character_description = desc_cache[img_hash]
+        else:
+            status_text.text("Analyzing base character...")
+            character_description = utils.describe_character(base_image)
+            if character_description != utils.DEFAULT_DESCRIPTION:
+                desc_cache[img_hash] = character_description
+        
+        # Encoded once here rather than once per stamp
+        reference_png = utils.encode_reference_image(base_image)
+        
+        status_text.text(f"Generating {MAX_ITEMS} stamps...")
+        # Runs on utils' background event loop; results are drawn here, on the script thread.
+        results = queue.Queue()
+        batch = utils.submit(utils.generate_stamp_batch_async(
+            base_image, lines[:MAX_ITEMS],
+            style_prompt="Anime style, cute, expressive",
+            character_description=character_description,
+            reference_png=reference_png,
+            use_cache=reuse_stamps,
+            results=results,
+        ))
+        try:
+            for done in range(1, MAX_ITEMS + 1):
+                show_result(*results.get(), done)
+            batch.result()
+        finally:
+            # Stop, a rerun or a widget change interrupts the script here; cancel the
+            # batch so its remaining Imagen requests aren't still sent (and billed).
+            batch.cancel()
+
         status_text.text("Generation Complete!")
         
         # Download Button
         if generated_images:
-            zip_data = utils.create_zip(generated_images)
+            # Build the archive only when the user clicks, instead of keeping it in memory up front.
+            def build_zip():
+                return utils.create_zip(generated_images)
+            
             st.download_button(
                 label="📦 Download All (ZIP)",
-                data=zip_data,
+                data=build_zip,
                 file_name="line_stamps.zip",
                 mime="application/zip",
                 key="download-btn"
@@ -1,196 +1,643 @@
 import os
 import io
+import asyncio
+import shutil
 import zipfile
+import hashlib
+import functools
 import textwrap
+import atexit
+import queue
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import logging.handlers
+import httpx
+import streamlit as st
 from google import genai
 from google.genai import types
 from PIL import Image
 
+logger = logging.getLogger(__name__)
+
+# Records go through a queue to a background thread, so a burst of errors from
+# concurrent stamps never blocks the event loop on a slow stdout.
+if not logger.handlers:  # Streamlit may re-import this module on file changes
+    _log_queue = queue.SimpleQueue()
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    _log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+    logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
 # Global client instance
 _client = None
 
+# Longest edge (px) of the base image sent to the APIs; larger uploads only add payload and tokens.
+MAX_INPUT_EDGE = 1024
+
+# The vision model describes the character just as well from a smaller image, with fewer tokens.
+DESCRIBE_MAX_EDGE = 512
+
+# reducing_gap for thumbnail(): box-reduce by an integer factor first, then Lanczos on
+# the smaller image. Pillow's default (2.0) never reduces 1024 -> 370x320; 1.5 does.
+RESIZE_REDUCING_GAP = 1.5
+
+# PNG encoder settings for every save: level 1 is ~3x faster than Pillow's default 6
+# and only a few percent larger on 370x320 stamps.
+PNG_SAVE_OPTIONS = {"optimize": False, "compress_level": 1}
+
+# Quantize stamps to a 256-color palette before encoding (fast octree, keeps alpha).
+# PNGs get ~3x smaller and encode faster, but it's lossy and bands shaded art, and the
+# ZIP is what gets submitted to LINE, so it's off unless you opt in.
+PALETTIZE_STAMPS = False
+
+# Concurrent Imagen requests per stamp set (keeps us under the API rate limits)
+MAX_CONCURRENT_STAMPS = 5
+
+# Character descriptions kept in memory for reuse (a few KB each)
+DESCRIPTION_CACHE_SIZE = 8
+
+# Generated stamps kept in memory for reuse (~100-300 KB each)
+STAMP_CACHE_SIZE = 128
+
+# Connection pool for the Gemini clients. httpx drops idle connections after 5s by
+# default, which is shorter than the gap between two Generate clicks.
+_HTTP_LIMITS = httpx.Limits(max_connections=16, max_keepalive_connections=16, keepalive_expiry=60)
+
+@st.cache_resource(show_spinner=False)
+def _get_client(api_key):
+    """Creates one client per API key and keeps it (and its pooled connections) across reruns."""
+    # HTTP/2 lets the concurrent aio requests share one multiplexed connection.
+    # Passing our own httpx client also keeps the SDK off aiohttp, which has no HTTP/2.
+    http_options = types.HttpOptions(
+        client_args={"limits": _HTTP_LIMITS},
+        httpx_async_client=httpx.AsyncClient(http2=True, limits=_HTTP_LIMITS),
+    )
+    return genai.Client(api_key=api_key, http_options=http_options)
+
+# The async client's connections belong to the event loop that opened them, and the
+# client outlives a single run, so every coroutine runs on this one background loop.
+_loop = None
+_loop_lock = threading.Lock()
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="gemini-aio", daemon=True).start()
+    return _loop
+
+def submit(coro):
+    """
+    Schedules a coroutine (e.g. built on generate_stamp_async) on the shared event loop.
+    
+    Returns:
+        concurrent.futures.Future: Resolves to the coroutine's result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
 def init_gemini(api_key):
     """Initializes the Gemini API Client with the provided key."""
     global _client
     if not api_key:
         return False, "API Key is missing."
     try:
-        # Initialize the client
-        _client = genai.Client(api_key=api_key)
+        # Streamlit calls this on every rerun; reuse the cached client instead of rebuilding it
+        _client = _get_client(api_key)
         # Verify by making a cheap call? Or just assume it's good if valid format.
         # Actually initializing the client doesn't validate the key until a call is made.
         return True, "API Key configured successfully."
     except Exception as e:
         return False, str(e)
 
-def generate_stamp(base_image, text, style_prompt=""):
+def open_base_image(fp):
+    """
+    Opens an uploaded base character image.
+    JPEGs are decoded at a reduced scale (libjpeg DCT scaling) when that still
+    covers MAX_INPUT_EDGE, since nothing downstream needs more resolution.
+    
+    Args:
+        fp: A filename or binary file object (e.g. a Streamlit UploadedFile).
+    
+    Returns:
+        PIL.Image: The opened image.
+    """
+    image = Image.open(fp)
+    if image.format == 'JPEG':
+        image.draft('RGB', (MAX_INPUT_EDGE, MAX_INPUT_EDGE))
+    return image
+
+def _downscale(image, max_edge=MAX_INPUT_EDGE):
+    """Returns a copy of image fitting in max_edge x max_edge, or the image itself if it already fits."""
+    if max(image.size) <= max_edge:
+        return image
+    resized = image.copy()
+    resized.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+    return resized
+
+# Image modes Pillow can write as PNG; anything else is converted first.
+_PNG_MODES = ('1', 'L', 'LA', 'I', 'I;16', 'P', 'RGB', 'RGBA')
+
+def encode_reference_image(base_image):
+    """
+    Downscales and encodes the base character to PNG for Imagen's reference image.
+    Call it once per base image and pass the bytes to every generate_stamp call.
+    
+    Args:
+        base_image (PIL.Image): The reference character image.
+    
+    Returns:
+        bytes: The PNG-encoded reference image.
+    """
+    image = _downscale(base_image)
+    if image.mode not in _PNG_MODES:
+        # e.g. CMYK JPEGs, which PNG can't store
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format='PNG', **PNG_SAVE_OPTIONS)
+    return img_byte_arr.getvalue()
+
+# Step 1: Deep analysis of the character
+_ANALYSIS_PROMPT = textwrap.dedent("""
+    Analyze this character image for a LINE sticker project. 
+    Identify and describe in detail:
+    1. Art Style & Line Quality: (e.g., thick/thin lines, clean/sketchy, vector/hand-drawn)
+    2. Color Palette: (exact colors, shading style, gradients)
+    3. Key Features: (proportions, eye shape, accessories, hair style)
+    4. Unique Identifiers: (patterns, marks, specific costume details)
+    
+    Provide the analysis in a way that helps another AI model reproduce this EXACT character consistently.
+    """).strip()
+
+# Used when the character can't be described (no image, API error)
+DEFAULT_DESCRIPTION = "A cute mascot character."
+
+def _image_digest(image):
+    """Identifies a PIL image by the BLAKE2b digest of its pixel data."""
+    return hashlib.blake2b(image.tobytes(), digest_size=16).hexdigest()
+
+# Character descriptions keyed by image digest (LRU, most recent last). Only the
+# digest is kept, so cached uploads don't pin their full-size pixels in memory.
+_descriptions = collections.OrderedDict()
+_descriptions_lock = threading.Lock()
+
+_describe_locks = {}
+_describe_locks_guard = threading.Lock()
+
+def _describe(image):
+    """Asks Gemini for the character description. Raises instead of returning an empty one."""
+    response = _client.models.generate_content(
+        model='gemini-2.0-flash',
+        contents=[_ANALYSIS_PROMPT, _downscale(image, DESCRIBE_MAX_EDGE)],
+        # A bounded, mostly deterministic description; Flash is plenty for this
+        config=types.GenerateContentConfig(temperature=0.2, max_output_tokens=512)
+    )
+    if not response.text:
+        # e.g. a safety-blocked reply; raising keeps it out of the cache so the next run retries
+        raise ValueError("Empty description returned by the model.")
+    return response.text
+
+def _cached_description(digest):
+    with _descriptions_lock:
+        description = _descriptions.get(digest)
+        if description is not None:
+            _descriptions.move_to_end(digest)
+        return description
+
+def _cache_description(digest, description):
+    with _descriptions_lock:
+        _descriptions[digest] = description
+        _descriptions.move_to_end(digest)
+        while len(_descriptions) > DESCRIPTION_CACHE_SIZE:
+            _descriptions.popitem(last=False)
+
+def describe_character(base_image):
+    """
+    Describes the base character with Gemini 2.0 Flash so it can be reused for every stamp.
+    Results are cached per image content, so repeated runs with the same image skip the call.
+    
+    Args:
+        base_image (PIL.Image): The reference character image.
+    
+    Returns:
+        str: The character description, or a generic one if unavailable.
+    """
+    if not base_image or not _client:
+        return DEFAULT_DESCRIPTION
+    try:
+        digest = _image_digest(base_image)
+        # A cache lookup alone doesn't stop concurrent misses for the same image from each
+        # calling the API; a per-image lock lets the first caller fill the cache for the rest.
+        with _describe_locks_guard:
+            lock = _describe_locks.setdefault(digest, threading.Lock())
+        try:
+            with lock:
+                character_description = _cached_description(digest)
+                if character_description is None:
+                    character_description = _describe(base_image)
+                    _cache_description(digest, character_description)
+        finally:
+            # Drop the lock once the cache is filled (or the call failed) so the table
+            # doesn't grow with every image ever seen. Late waiters still hold it.
+            with _describe_locks_guard:
+                if _describe_locks.get(digest) is lock:
+                    del _describe_locks[digest]
+        return character_description
+    except Exception:
+        logger.exception("Error describing image")
+    return DEFAULT_DESCRIPTION
+
+_REFERENCE_ID = "input_character"
+
+# Static part of the Imagen prompt, filled per stamp with .format(). Joined line by
+# line so no source indentation is sent as prompt tokens.
+_STAMP_PROMPT_TEMPLATE = "\n".join([
+    "A professional LINE sticker illustration.",
+    f"Subject: The character [{_REFERENCE_ID}]",
+    "Action/Emotion: {text}",
+    "",
+    "Style Reconstruction Guide:",
+    "{character_description}",
+    "",
+    f"CRITICAL: Maintain absolute consistency with [{_REFERENCE_ID}]. Use the exact same line style, color treatment, and character proportions as the reference image.",
+    "Background: Pure white background.",
+    "Composition: Vector art, clean lines, high quality, 2D illustration.",
+])
+
+@functools.lru_cache(maxsize=1)
+def _stamp_config(reference_png):
+    """
+    Builds the Imagen 4 config for a stamp set. It only depends on the reference
+    image, so it is built once per set; bytes cache their hash, making hits O(1).
+    """
+    # Step 2: Generate Image with Imagen 4 using SubjectReferenceImage
+    # Prepare the reference images list
+    reference_images = []
+    if reference_png:
+        reference_images.append(
+            types.ReferenceImage(
+                reference_id=_REFERENCE_ID,
+                reference_type="SUBJECT",
+                image=types.Part.from_bytes(
+                    data=reference_png,
+                    mime_type="image/png"
+                )
+            )
+        )
+
+    # Note: Imagen 4 configuration
+    return types.GenerateImagesConfig(
+        # One image per request: number_of_images returns variations of a single prompt,
+        # so several texts can't share a call. Throughput comes from concurrent requests instead.
+        number_of_images=1,
+        aspect_ratio="1:1",
+        include_rai_reason=True,
+        reference_images=reference_images if reference_images else None,
+        # strength=1.0 # If SDK supports this for reference images influence
+    )
+
+def _stamp_request(reference_png, text, character_description):
+    """Builds the Imagen 4 prompt and config for a single stamp."""
+    full_prompt = _STAMP_PROMPT_TEMPLATE.format(text=text, character_description=character_description)
+    return full_prompt, _stamp_config(reference_png)
+
+@functools.lru_cache(maxsize=1)
+def _list_model_names(client):
+    """Lists the model names available to client, fetched once per client."""
+    return tuple(m.name for m in client.models.list())
+
+def _model_not_found_error(error_str):
+    """Builds the error message for a 404 from Imagen, listing the models available on the key."""
+    # Attempt to list models to help debugging
+    try:
+        model_names = list(_list_model_names(_client))
+        return f"Model 'imagen-4.0-generate-001' not found. Available models on your key: {model_names}. ERROR details: {error_str}"
+    except Exception as list_err:
+        return f"Model not found and failed to list models: {list_err}. Original error: {error_str}"
+
+def _is_model_not_found(error_str):
+    # Quota errors are never a missing model, so don't pay for a model listing on them.
+    if "RESOURCE_EXHAUSTED" in error_str:
+        return False
+    return "404" in error_str or "NOT_FOUND" in error_str
+
+def _extract_image_bytes_new(generated_image_obj):
+    """Reads the bytes of a GeneratedImage from the current SDK (types.Image.image_bytes)."""
+    image = generated_image_obj.image
+    return image.image_bytes if image is not None else None
+
+def _extract_image_bytes_legacy(generated_image_obj):
+    """Tries the various ways older SDKs provided the bytes. Returns None if none works."""
+    image_bytes = None
+    
+    if hasattr(generated_image_obj, 'image'):
+        img_attr = generated_image_obj.image
+        if isinstance(img_attr, bytes):
+            image_bytes = img_attr
+        elif hasattr(img_attr, 'image_bytes'): # Public attribute in new SDK
+            image_bytes = img_attr.image_bytes
+        elif hasattr(img_attr, '_image_bytes'): # Internal attribute
+            image_bytes = img_attr._image_bytes
+    
+    if image_bytes is None and hasattr(generated_image_obj, 'binary'):
+        image_bytes = generated_image_obj.binary
+    
+    if image_bytes is None:
+        # Final attempt: direct cast to bytes if it's some bytes-compatible object
+        try:
+            image_bytes = bytes(generated_image_obj.image)
+        except:
+            return None
+    
+    return image_bytes
+
+# The installed SDK's response layout doesn't change at runtime, so pick the
+# extractor once here instead of probing attributes on every stamp.
+if hasattr(types, 'GeneratedImage') and 'image_bytes' in getattr(types.Image, 'model_fields', {}):
+    _extract_image_bytes = _extract_image_bytes_new
+else:
+    _extract_image_bytes = _extract_image_bytes_legacy
+
+def _encode_png_buffer(image):
+    """Encodes a PIL image to PNG (palettized if PALETTIZE_STAMPS) in a BytesIO at position 0."""
+    if PALETTIZE_STAMPS and image.mode in ('RGB', 'RGBA'):
+        image = image.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format='PNG', **PNG_SAVE_OPTIONS)
+    img_byte_arr.seek(0)
+    return img_byte_arr
+
+def _encode_png(image):
+    """Encodes a PIL image to PNG bytes (palettized if PALETTIZE_STAMPS)."""
+    return _encode_png_buffer(image).getvalue()
+
+def _stamp_from_response(response):
+    """
+    Converts an Imagen response into a LINE-sized PIL Image and its PNG bytes.
+    
+    Returns:
+        tuple: (PIL.Image or None, bytes or None, str or None) - The generated image,
+            its PNG encoding and an error message if any.
+    """
+    if response.generated_images:
+        generated_image_obj = response.generated_images[0]
+        
+        # The SDK returns a GeneratedImage object. 
+        # To ensure we have a PIL Image with .thumbnail(), we load it from the binary data.
+        try:
+            image_bytes = _extract_image_bytes(generated_image_obj)
+            if image_bytes is None:
+                return None, None, f"Could not extract image bytes from {type(getattr(generated_image_obj, 'image', None))}"
+            
+            # Load as PIL Image
+            generated_image = Image.open(io.BytesIO(image_bytes))
+        except Exception as e:
+            logger.exception("Error converting response to PIL Image")
+            return None, None, f"Failed to process generated image: {e}"
+
+        # RESIZE to LINE specs (max 370x320)
+        if generated_image:
+            original_size, original_format = generated_image.size, generated_image.format
+            # Bicubic is about half the cost of Lanczos here, with no visible difference at sticker size
+            generated_image.thumbnail((370, 320), Image.Resampling.BICUBIC, reducing_gap=RESIZE_REDUCING_GAP)
+            # Keep the API's own PNG when no resize happened; otherwise encode the resized image once.
+            if generated_image.size == original_size and original_format == 'PNG' and not PALETTIZE_STAMPS:
+                png_bytes = image_bytes
+            else:
+                png_bytes = _encode_png(generated_image)
+            return generated_image, png_bytes, None
+    
+    return None, None, "No image returned from API."
+
+# Generated stamps keyed by client + prompt + reference image, as PNG bytes (LRU, most
+# recent last). The client (one per API key) is part of the key so a session never gets
+# stamps generated under another user's key.
+_stamp_cache = collections.OrderedDict()
+_stamp_cache_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def _reference_digest(reference_png):
+    return hashlib.sha256(reference_png).digest()
+
+def _stamp_cache_key(client, full_prompt, reference_png):
+    key = hashlib.sha256(full_prompt.encode())
+    if reference_png:
+        key.update(_reference_digest(reference_png))
+    return client, key.hexdigest()
+
+def _cached_stamp(key):
+    """Returns a previously generated stamp as (PIL.Image, bytes, None), or None on a miss."""
+    with _stamp_cache_lock:
+        png_bytes = _stamp_cache.get(key)
+        if png_bytes is None:
+            return None
+        _stamp_cache.move_to_end(key)
+    return Image.open(io.BytesIO(png_bytes)), png_bytes, None
+
+def _cache_stamp(key, result):
+    """Stores a successful generate_stamp result and passes it through."""
+    png_bytes = result[1]
+    if png_bytes is not None:
+        with _stamp_cache_lock:
+            _stamp_cache[key] = png_bytes
+            _stamp_cache.move_to_end(key)
+            while len(_stamp_cache) > STAMP_CACHE_SIZE:
+                _stamp_cache.popitem(last=False)
+    return result
+
+def generate_stamp(base_image, text, style_prompt="", character_description=None, reference_png=None, use_cache=True):
     """
     Generates a stamp image using Gemini (Imagen 3) based on a base image and text.
     Uses a two-step process:
-    1. Describe the base image (if present) using Gemini 1.5 Pro.
+    1. Describe the base image (if present) using Gemini 2.0 Flash.
     2. Generate the stamp using Imagen 3 with the description + text.
     
     Args:
         base_image (PIL.Image): The reference character image.
         text (str): The text/dialogue for the stamp.
         style_prompt (str): Additional style description.
+        character_description (str): Output of describe_character(base_image).
+            Pass it when generating several stamps so step 1 runs only once.
+        reference_png (bytes): Output of encode_reference_image(base_image), likewise
+            computed once per set instead of re-encoding the base image for every stamp.
+        use_cache (bool): Return the stamp generated earlier for the same API key, prompt
+            and reference image instead of calling Imagen again. False always regenerates.
     
     Returns:
-        tuple: (PIL.Image or None, str or None) - The generated image and an error message if any.
+        tuple: (PIL.Image or None, bytes or None, str or None) - The generated image,
+            its PNG bytes (ready for create_zip) and an error message if any.
     """
     global _client
     if not _client:
-        return None, "API not initialized. Please configure API Key."
+        return None, None, "API not initialized. Please configure API Key."
 
     try:
-        # Step 1: Describe the base image if provided
-        character_description = "A cute mascot character."
-        
-        if base_image:
-            try:
-                # Step 1: Deep analysis of the character
-                analysis_prompt = """
-                Analyze this character image for a LINE sticker project. 
-                Identify and describe in detail:
-                1. Art Style & Line Quality: (e.g., thick/thin lines, clean/sketchy, vector/hand-drawn)
-                2. Color Palette: (exact colors, shading style, gradients)
-                3. Key Features: (proportions, eye shape, accessories, hair style)
-                4. Unique Identifiers: (patterns, marks, specific costume details)
-                
-                Provide the analysis in a way that helps another AI model reproduce this EXACT character consistently.
-                """
-                
-                response = _client.models.generate_content(
-                    model='gemini-1.5-pro',
-                    contents=[analysis_prompt, base_image]
-                )
-                if response.text:
-                    character_description = response.text
-            except Exception as e:
-                print(f"Error describing image: {e}")
-                pass
-
-        # Step 2: Generate Image with Imagen 4 using SubjectReferenceImage
-        ref_id = "input_character"
-        
-        # Prepare the reference images list
-        reference_images = []
-        if base_image:
-            # Convert PIL image to bytes for the SDK
-            img_byte_arr = io.BytesIO()
-            base_image.save(img_byte_arr, format='PNG')
-            
-            reference_images.append(
-                types.ReferenceImage(
-                    reference_id=ref_id,
-                    reference_type="SUBJECT",
-                    image=types.Part.from_bytes(
-                        data=img_byte_arr.getvalue(),
-                        mime_type="image/png"
-                    )
-                )
-            )
-
-        full_prompt = f"""
-        A professional LINE sticker illustration.
-        Subject: The character [{ref_id}]
-        Action/Emotion: {text}
-        
-        Style Reconstruction Guide:
-        {character_description}
-        
-        CRITICAL: Maintain absolute consistency with [{ref_id}]. Use the exact same line style, color treatment, and character proportions as the reference image.
-        Background: Pure white background.
-        Composition: Vector art, clean lines, high quality, 2D illustration.
-        """
+        if character_description is None:
+            character_description = describe_character(base_image)
+        if reference_png is None and base_image:
+            reference_png = encode_reference_image(base_image)
+        full_prompt, config = _stamp_request(reference_png, text, character_description)
+        cache_key = _stamp_cache_key(_client, full_prompt, reference_png)
+        if use_cache:
+            cached = _cached_stamp(cache_key)
+            if cached:
+                return cached
         
         try:
-            # Note: Imagen 4 configuration
             response = _client.models.generate_images(
                 model='imagen-4.0-generate-001',
                 prompt=full_prompt,
-                config=types.GenerateImagesConfig(
-                    number_of_images=1,
-                    aspect_ratio="1:1",
-                    include_rai_reason=True,
-                    reference_images=reference_images if reference_images else None,
-                    # strength=1.0 # If SDK supports this for reference images influence
-                )
+                config=config
             )
         except Exception as e:
             # Check for 404 or other API errors
             error_str = str(e)
-            if "404" in error_str or "NOT_FOUND" in error_str:
-                # Attempt to list models to help debugging
-                try:
-                    all_models = _client.models.list()
-                    # Filter for image generation models if possible, or just list a few
-                    model_names = [m.name for m in all_models]
-                    return None, f"Model 'imagen-4.0-generate-001' not found. Available models on your key: {model_names}. ERROR details: {error_str}"
-                except Exception as list_err:
-                     return None, f"Model not found and failed to list models: {list_err}. Original error: {error_str}"
+            if _is_model_not_found(error_str):
+                return None, None, _model_not_found_error(error_str)
             else:
                 raise e
         
-        if response.generated_images:
-            generated_image_obj = response.generated_images[0]
-            
-            # The SDK returns a GeneratedImage object. 
-            # To ensure we have a PIL Image with .thumbnail(), we load it from the binary data.
-            try:
-                image_bytes = None
-                
-                # Try various ways the SDK might provide the bytes
-                if hasattr(generated_image_obj, 'image'):
-                    img_attr = generated_image_obj.image
-                    if isinstance(img_attr, bytes):
-                        image_bytes = img_attr
-                    elif hasattr(img_attr, 'image_bytes'): # Public attribute in new SDK
-                        image_bytes = img_attr.image_bytes
-                    elif hasattr(img_attr, '_image_bytes'): # Internal attribute
-                        image_bytes = img_attr._image_bytes
-                
-                if image_bytes is None and hasattr(generated_image_obj, 'binary'):
-                    image_bytes = generated_image_obj.binary
-                
-                if image_bytes is None:
-                    # Final attempt: direct cast to bytes if it's some bytes-compatible object
-                    try:
-                        image_bytes = bytes(generated_image_obj.image)
-                    except:
-                        return None, f"Could not extract image bytes from {type(generated_image_obj.image)}"
-                
-                # Load as PIL Image
-                generated_image = Image.open(io.BytesIO(image_bytes))
-            except Exception as e:
-                print(f"Error converting response to PIL Image: {e}")
-                return None, f"Failed to process generated image: {e}"
-
-            # RESIZE to LINE specs (max 370x320)
-            if generated_image:
-                generated_image.thumbnail((370, 320), Image.Resampling.LANCZOS)
-                return generated_image, None
+        return _cache_stamp(cache_key, _stamp_from_response(response))
+
+    except Exception as e:
+        logger.exception("Error generating image")
+        return None, None, str(e)
+
+async def generate_stamp_async(base_image, text, style_prompt="", character_description=None, reference_png=None, use_cache=True):
+    """
+    Async counterpart of generate_stamp using the client's aio surface,
+    so several stamps can be generated concurrently on one event loop.
+    
+    Returns:
+        tuple: (PIL.Image or None, bytes or None, str or None) - The generated image,
+            its PNG bytes (ready for create_zip) and an error message if any.
+    """
+    if not _client:
+        return None, None, "API not initialized. Please configure API Key."
+
+    try:
+        if character_description is None:
+            # Cached after the first call, so this only blocks the loop once per image.
+            character_description = describe_character(base_image)
+        if reference_png is None and base_image:
+            reference_png = encode_reference_image(base_image)
+        full_prompt, config = _stamp_request(reference_png, text, character_description)
+        cache_key = _stamp_cache_key(_client, full_prompt, reference_png)
+        if use_cache:
+            cached = _cached_stamp(cache_key)
+            if cached:
+                return cached
+        
+        try:
+            response = await _client.aio.models.generate_images(
+                model='imagen-4.0-generate-001',
+                prompt=full_prompt,
+                config=config
+            )
+        except Exception as e:
+            error_str = str(e)
+            if _is_model_not_found(error_str):
+                # Listing models is a rare, blocking debug call; keep it off the event loop.
+                return None, None, await asyncio.to_thread(_model_not_found_error, error_str)
+            else:
+                raise e
         
-        return None, "No image returned from API."
+        return _cache_stamp(cache_key, _stamp_from_response(response))
 
     except Exception as e:
-        print(f"Error generating image: {e}")
-        return None, str(e)
+        logger.exception("Error generating image")
+        return None, None, str(e)
+
+async def generate_stamp_batch_async(base_image, texts, style_prompt="", character_description=None, reference_png=None, use_cache=True, max_parallel=MAX_CONCURRENT_STAMPS, results=None):
+    """
+    Generates a whole stamp set concurrently, with up to max_parallel Imagen requests
+    at a time. Schedule it with submit(); it must run on the shared event loop.
+    
+    Args:
+        base_image (PIL.Image): The reference character image.
+        texts (list): The text/dialogue for each stamp.
+        style_prompt (str): Additional style description.
+        character_description (str): See generate_stamp. Described once for the set if omitted.
+        reference_png (bytes): See generate_stamp. Encoded once for the set if omitted.
+        use_cache (bool): See generate_stamp.
+        max_parallel (int): Maximum number of concurrent Imagen requests.
+        results (queue.Queue): Optional. Each stamp is put on it as soon as it finishes, as
+            (index, text, PIL.Image or None, bytes or None, str or None). Exactly one entry
+            is put per text, even if generation fails or the batch is cancelled.
+    
+    Returns:
+        list: One (PIL.Image or None, bytes or None, str or None) tuple per text, in order.
+    """
+    # Both block, so keep them off the event loop.
+    if character_description is None:
+        character_description = await asyncio.to_thread(describe_character, base_image)
+    if reference_png is None and base_image:
+        reference_png = await asyncio.to_thread(encode_reference_image, base_image)
+    semaphore = asyncio.Semaphore(max_parallel)
+
+    async def _generate(i, text):
+        result = None, None, "Generation was cancelled."
+        try:
+            async with semaphore:
+                result = await generate_stamp_async(
+                    base_image, text, style_prompt,
+                    character_description=character_description,
+                    reference_png=reference_png,
+                    use_cache=use_cache,
+                )
+        except Exception as e:
+            result = None, None, str(e)
+        finally:
+            # Callers may wait for exactly one entry per stamp, so always report back.
+            if results is not None:
+                results.put((i, text, *result))
+        return result
+
+    return await asyncio.gather(*(_generate(i, text) for i, text in enumerate(texts)))
+
+def _write_zip(fileobj, images_map):
+    """Writes images_map into fileobj as a ZIP archive of PNGs."""
+    # Encode PIL images in parallel (Pillow releases the GIL while compressing).
+    # zipfile isn't thread-safe, so the members are then written sequentially.
+    to_encode = {name: img for name, img in images_map.items() if not isinstance(img, bytes)}
+    encoded = {}
+    if to_encode:
+        with ThreadPoolExecutor(max_workers=min(len(to_encode), os.cpu_count() or 1)) as ex:
+            encoded = dict(zip(to_encode, ex.map(_encode_png_buffer, to_encode.values())))
+    
+    # PNGs are already deflate-compressed, so store them as-is instead of deflating twice.
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_STORED) as zf:
+        for filename, img in images_map.items():
+            if filename not in encoded:
+                # Already-encoded PNGs (e.g. from generate_stamp) go in without a decode/re-encode.
+                zf.writestr(filename, img)
+                continue
+            # Stream the encoded buffer in 1 MiB chunks rather than copying it out with getvalue().
+            with zf.open(filename, "w") as dst:
+                shutil.copyfileobj(encoded[filename], dst, length=1 << 20)
 
 def create_zip(images_map):
     """
-    Creates a ZIP file from a dictionary of {filename: PIL.Image}.
+    Creates a ZIP file from a dictionary of {filename: PIL.Image or PNG bytes}.
     
     Args:
-        images_map (dict): Keys are filenames (e.g., "stamp_01.png"), values are PIL Images.
+        images_map (dict): Keys are filenames (e.g., "stamp_01.png"), values are PIL Images
+            or already-encoded PNG bytes, which are stored as-is.
         
     Returns:
-        bytes: The ZIP file content.
+        io.BytesIO: The ZIP file content, positioned at the start. Pass it straight to
+            st.download_button / send_file, or call getbuffer() for a zero-copy view.
     """
     zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-        for filename, img in images_map.items():
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='PNG')
-            zf.writestr(filename, img_byte_arr.getvalue())
-    return zip_buffer.getvalue()
+    # Coalesce the many small writes from zipfile/PIL into 64 KiB chunks.
+    buffered = io.BufferedWriter(zip_buffer, buffer_size=65536)
+    _write_zip(buffered, images_map)
+    # Flush and release the BytesIO without closing it.
+    buffered.detach()
+    # Hand back the buffer itself; getvalue() would copy the whole archive.
+    zip_buffer.seek(0)
+    return zip_buffer